@@ -35,15 +35,15 @@ def main():
     args = parser.parse_args(sys.argv[1:])
 
     minscore_high = args.minscore
-    labileptms = [x.lower() for x in args.labileptms]
-    stabileptms = [x.lower() for x in args.stabileptms]
+    labileptms = frozenset(x.lower() for x in args.labileptms)
+    stabileptms = frozenset(x.lower() for x in args.stabileptms)
     mods = [x.lower() for x in args.mods]
 
     # First prepare a residue + PTM weight -> PTM name dict for naming mods
     msgfmods = Mods()
     msgfmods.parse_msgf_modfile(args.modfile, [*args.labileptms, *args.stabileptms, *args.mods])
     luci_modmap = msgfmods.lucimass_mod_dict()
-    msgf_mod_map = msgfmods.msgfmass_mod_dict()
+    msgf_mod_map = msgfmods.msgfmass_int_dict()
 
     # load sequences
     tdb = SeqIO.index(args.fasta, 'fasta')
@@ -118,7 +118,7 @@ def main():
 
             # Get protein site location of mods
             if MASTER_PROTEIN in psm:
-                annotate_protein_and_flanks(psm, luciptm, tdb, [*labileptms, *stabileptms])
+                annotate_protein_and_flanks(psm, luciptm, tdb, labileptms | stabileptms)
             outpsm = {k: v for k,v in psm.items()}
             outpsm.update(ptm)
             outpsm[SE_PEPTIDE] = outpsm.pop(PEPTIDE)
@@ -2,10 +2,14 @@
 
 import sys
 import re
+import mmap
 from os import environ
 import argparse
+from collections import defaultdict, deque
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
 
-from jinja2 import Template
+from jinja2 import Environment, StrictUndefined
 
 NON_BLOCKING_MODS = {
         'GG': ['TMTpro', 'TMT6plex', 'iTRAQ8plex', 'iTRAQ4plex'],
@@ -36,6 +40,18 @@ aa_weights_monoiso = { # From ExPASY
         'O': 237.147727,
         }
 
+# Peptide parsing patterns, compiled once since they run for every PSM
+# MSGF: residue (or protein N-term) followed by one or more signed masses, e.g. K+229.163-187.152
+_MSGF_MOD_RE = re.compile(r'([A-Z])?((?:[+\-][0-9.]+)+)')
+_MASS_RE = re.compile(r'[+\-][0-9.]+')
+# Luciphor: residue (or protein N-term) followed by bracketed integer residue+mod mass, e.g. S[167]
+_LUCI_MOD_RE = re.compile(r'([A-Z])?\[([0-9]+)\]')
+# Bit flags per mod type, so PSMs can track which types they contain
+_TYPE_BITS = {'fixed': 1, 'labile': 2, 'stable': 4, 'variable': 8}
+
+# Luciphor score permutation: modified residues are lowercase
+_LOWER_RE = re.compile(r'[a-z]')
+
 
 class Mods:
     '''
@@ -54,7 +70,8 @@ class Mods:
     def parse_msgf_modfile(self, modfile, mods_passed):
         # FIXME make sure parsing is only Unimod/mass, then set
         # fixed/var, pos, res yourself in this method
-        mods_to_find = [x.lower() for x in mods_passed]
+        # mods_passed keeps its case, custom mod definitions in it have names for output
+        mods_to_find = frozenset(x.lower() for x in mods_passed)
         with open(modfile) as fp:
             for line in fp:
                 line = line.strip('\n')
@@ -66,13 +83,12 @@ class Mods:
                 pos = msplit[3]
                 varfix = msplit[2]
                 residues = set(msplit[1])
+                lowername = name.lower()
                 # tmt6plex can be hidden tmt10plex, same UNIMOD mass/name
-                if name.lower() == 'tmt6plex' and 'tmt10plex' in mods_to_find:
+                if lowername == 'tmt6plex' and 'tmt10plex' in mods_to_find:
                     lowername = 'tmt10plex'
-                elif name.lower() not in mods_to_find:
+                elif lowername not in mods_to_find:
                     continue
-                else:
-                    lowername = name.lower()
                 for res in residues:
                     self.mods.append({
                             'name': name, 'mass': float(msplit[0]),
@@ -97,17 +113,13 @@ class Mods:
                         'pos': pos, 'name_lower': name.lower()
                         })
 
-        fixedpos = {}
+        fixedpos = defaultdict(list)
         for mod in self.mods:
             if mod['var']:
                 self.varmods.append(mod)
             else:
                 self.fixedmods.append(mod)
-                res = mod['residue']
-                if res in fixedpos:
-                    fixedpos[res].append(mod)
-                else:
-                    fixedpos[res] = [mod]
+                fixedpos[mod['residue']].append(mod)
 
         # get blocking/nonblocking mods and adjust mass (fake mass)
         for mod in self.varmods:
@@ -120,36 +132,34 @@ class Mods:
                     adjustment += fmod['mass']
             mod['adjusted_mass'] = round(-(adjustment - mod['mass']), 5)
 
+        # Cache the mass that is used everywhere, and the MSGF output (round 3) version of it
+        for mod in self.mods:
+            mod['effective_mass'] = mod['adjusted_mass'] or mod['mass']
+            mod['msgf_mass'] = round(mod['effective_mass'], 3)
+
     def get_msgf_modlines(self):
-        grouped = {}
+        grouped = defaultdict(list)
+        names_seen = {}
         for mod in self.mods:
             mass = self.get_mass_or_adj(mod)
-            if mass not in grouped:
-                grouped[mass] = [mod]
-            else:
-                grouped[mass].append(mod)
-                check_names = set(x['name'] for x in grouped[mass])
-                if len(check_names) != 1:
-                    print('Cannot have two modifications of the same mass but different names')
-                    sys.exit(1)
+            if names_seen.setdefault(mass, mod['name']) != mod['name']:
+                print('Cannot have two modifications of the same mass but different names')
+                sys.exit(1)
+            grouped[mass].append(mod)
 
         for mass, mods in grouped.items():
             name = mods[0]['name']
-            line_res = {}
+            line_res = defaultdict(list)
             for mod in mods:
                 var = int(mod['var']) # T/F -> 1/0
-                mid = f'{var}__{mod["pos"]}'
-                if mid not in line_res:
-                    line_res[mid] = [mod['residue']]
-                else:
-                    line_res[mid].append(mod['residue'])
+                line_res[f'{var}__{mod["pos"]}'].append(mod['residue'])
             for mid, residues in line_res.items():
                 var, pos = mid.split('__')
                 vf = 'opt' if int(var) else 'fix'
                 yield f'{mass},{"".join(residues)},{vf},{pos},{name}'
 
     def get_mass_or_adj(self, mod):
-        return mod['adjusted_mass'] or mod['mass']
+        return mod['effective_mass']
  
     def get_luci_input_mod_line(self, mod):
         '''Doing this for each residue since the adjusted masses can differ
@@ -162,15 +172,13 @@ class Mods:
             residue = mod['residue']
         return f'{residue} {self.get_mass_or_adj(mod)}'
 
-    def msgfmass_mod_dict(self):
-        '''Create MSGF output mass (round(x,3) ) to mod lookup'''
-        mod_map = {}
+    def msgfmass_int_dict(self):
+        '''Create MSGF output mass (round(x,3) ) to mod lookup, keyed on
+        int(round(x * 1000)) to avoid float keys'''
+        mod_map = defaultdict(list)
         for mod in self.mods:
-            try:
-                mod_map[round(self.get_mass_or_adj(mod), 3)].append(mod)
-            except KeyError:
-                mod_map[round(self.get_mass_or_adj(mod), 3)] = [mod]
-        return mod_map
+            mod_map[int(round(mod['msgf_mass'] * 1000))].append(mod)
+        return dict(mod_map)
 
     def lucimass_mod_dict(self):
         '''Create luciphor output mass (int(x+ aa) ) to mod lookup'''
@@ -185,6 +193,7 @@ class Mods:
 class PSM: 
     def __init__(self):
         self.mods = []
+        self._typeflags = 0
         self.top_flr = False
         self.top_score = False
         self.lucispecid = False
@@ -193,29 +202,42 @@ class PSM:
         self.seq_in_scorepep_fmt = False
 
     def parse_msgf_peptide(self, msgfseq, msgf_mods, labileptmnames, stableptmnames):
+        '''msgf_mods is a Mods.msgfmass_int_dict() lookup, labileptmnames and
+        stableptmnames are (frozen)sets of lowercase mod names'''
         self.mods = []
-        barepep = ''
+        self._typeflags = 0
+        if '+' not in msgfseq and '-' not in msgfseq:
+            # Unmodified peptide, no need to run regex
+            self.sequence = msgfseq
+            return
+        # Collect unmodified stretches and join once, track length for site numbers
+        barepep, barelen = [], 0
         start = 0
-        for x in re.finditer('([A-Z]){0,1}([0-9\.+\-]+)', msgfseq):
+        for x in _MSGF_MOD_RE.finditer(msgfseq):
             if x.group(1) is not None:
                 # mod is on a residue
-                barepep = f'{barepep}{msgfseq[start:x.start()+1]}'
-                residue = barepep[-1]
-                sitenum = len(barepep) - 1
+                barepep.append(msgfseq[start:x.start()+1])
+                barelen += x.start() + 1 - start
+                residue = x.group(1)
+                sitenum = barelen - 1
             else:
                 # mod is on protein N-term
                 residue = '['
                 sitenum = -100
             # TODO cterm = 100, ']'
             start = x.end()
-            for mass in re.findall('[\+\-][0-9.]+', x.group(2)):
-                mod = msgf_mods[float(mass)][0] # only take first, contains enough info
+            for mass in _MASS_RE.findall(x.group(2)):
+                # only take first, contains enough info
+                mod = msgf_mods[int(round(float(mass) * 1000))][0]
+                mtype = self.get_modtype(mod, labileptmnames, stableptmnames)
+                self._typeflags |= _TYPE_BITS[mtype]
                 self.mods.append({
-                    'site': (residue, sitenum), 'type': self.get_modtype(mod, labileptmnames, stableptmnames),
+                    'site': (residue, sitenum), 'type': mtype,
                     'mass': mod['mass'], 'name': mod['name'], 'name_lower': mod['name_lower'],
                     'adjusted_mass': mod['adjusted_mass']
                     })
-        self.sequence = f'{barepep}{msgfseq[start:]}'
+        barepep.append(msgfseq[start:])
+        self.sequence = ''.join(barepep)
 
     def get_modtype(self, mod, labileptmnames, stableptmnames):
         if not mod['var']:
@@ -231,68 +253,77 @@ class PSM:
     def parse_luciphor_peptide(self, luciline, ptms_map, labileptms, stabileptms):
         '''From a luciphor sequence, create a peptide with PTMs
         ptms_map = {f'{residue}int(79 + mass_S/T/Y)': {'name': Phospho, etc}
+        labileptms and stabileptms are (frozen)sets of lowercase mod names
         '''
         self.top_flr = luciline['globalFLR']
         self.top_score = luciline['pep1score']
         self.lucispecid = luciline['specId']
         self.mods = []
-        barepep, start = '', 0
+        self._typeflags = 0
+        barepep, barelen, start = [], 0, 0
+        # Score peptide format has modified residues lowercased, collect it in same pass
+        scorepep = []
+        residue, sitenum = '[', -100
         modpep = luciline['predictedPep1']
-        for x in re.finditer('([A-Z]){0,1}\[([0-9]+)\]', modpep):
+        for x in _LUCI_MOD_RE.finditer(modpep):
             if x.group(1) is not None: # check if residue (or protein N-term)
-                barepep += modpep[start:x.start()+1]
+                barepep.append(modpep[start:x.start()+1])
+                scorepep.append(f'{modpep[start:x.start()]}{x.group(1).lower()}')
+                barelen += x.start() + 1 - start
+                residue, sitenum = x.group(1), barelen - 1
+            else:
+                scorepep.append(modpep[start:x.end()])
             start = x.end()
             ptm = ptms_map[f'{x.group(1)}{int(x.group(2))}']
             if ptm['name_lower'] in labileptms:
-                sitenum = len(barepep) - 1 if len(barepep) else -100
-                residue = barepep[-1] if len(barepep) else '['
+                mtype = self.get_modtype(ptm, labileptms, stabileptms)
+                self._typeflags |= _TYPE_BITS[mtype]
                 self.mods.append({
-                    'site': (residue, sitenum), 'type': self.get_modtype(ptm, labileptms, stabileptms),
+                    'site': (residue, sitenum), 'type': mtype,
                     'mass': ptm['mass'], 'name': ptm['name'], 'name_lower': ptm['name_lower'],
                     })
-        self.sequence = f'{barepep}{modpep[start:]}'
-        self.seq_in_scorepep_fmt = re.sub(r'([A-Z])\[[0-9]+\]', lambda x: x.group(1).lower(), modpep)
+        barepep.append(modpep[start:])
+        scorepep.append(modpep[start:])
+        self.sequence = ''.join(barepep)
+        self.seq_in_scorepep_fmt = ''.join(scorepep)
 
     def parse_luciphor_scores(self, scorepep, minscore):
         permut = scorepep['curPermutation']
         if permut != self.seq_in_scorepep_fmt and float(scorepep['score']) > minscore:
-            self.alt_ptm_locs.append([f'{x.group()}{x.start() + 1}:{scorepep["score"]}'
-                for x in re.finditer('[a-z]', permut)])
+            # Store (residue, site, score), only format when outputting
+            score = scorepep['score']
+            self.alt_ptm_locs.append([(x.group(), x.start() + 1, score) for x in _LOWER_RE.finditer(permut)])
 
     def format_alt_ptm_locs(self):
-        alt_locs = [','.join(x).upper() for x in self.alt_ptm_locs]
-        return ';'.join(alt_locs) if len(alt_locs) else 'NA'
+        if not len(self.alt_ptm_locs):
+            return 'NA'
+        return ';'.join([','.join([f'{res}{site}:{score}' for res, site, score in x])
+            for x in self.alt_ptm_locs]).upper()
 
     def has_labileptms(self):
-        return any(m['type'] == 'labile' for m in self.mods)
+        return bool(self._typeflags & _TYPE_BITS['labile'])
     
     def has_stableptms(self):
-        return any(m['type'] == 'stable' for m in self.mods)
+        return bool(self._typeflags & _TYPE_BITS['stable'])
 
     def luciphor_input_sites(self):
-        lucimods = []
-        for m in self.mods:
-            if m['type'] != 'fixed':
-                lucimods.append((m['site'][1], str(m['mass'] + aa_weights_monoiso[m['site'][0]])))
-        return ','.join([f'{x[0]}={x[1]}' for x in lucimods])
+        return ','.join(f'{m["site"][1]}={m["mass"] + aa_weights_monoiso[m["site"][0]]}'
+                for m in self.mods if m['type'] != 'fixed')
 
     def add_ptms_from_psm(self, psmmods):
         existing_mods = {m['name']: m for m in self.mods}
         for psmmod in psmmods:
             if psmmod['name'] not in existing_mods:
+                self._typeflags |= _TYPE_BITS[psmmod['type']]
                 self.mods.append(psmmod)
 
     def topptm_output(self):
-        ptmsites = {}
+        ptmsites = defaultdict(list)
         output_types = {'labile', 'stable'}
         for ptm in self.mods:
             if ptm['type'] not in output_types:
                 continue
-            site = f'{ptm["site"][0]}{ptm["site"][1] + 1}'
-            try:
-                ptmsites[ptm['name']].append(site)
-            except KeyError:
-                ptmsites[ptm['name']] = [site]
+            ptmsites[ptm['name']].append(f'{ptm["site"][0]}{ptm["site"][1] + 1}')
         return '_'.join([f'{p}:{",".join(s)}' for p, s in ptmsites.items()])
 
 
@@ -300,6 +331,74 @@ def create_msgf_mod_lookup():
     lookup = {}
 
 
+# Read-only state for PSM table chunk processing, set once per worker process
+_PSM_CHUNK_STATE = {}
+
+def open_psm_mmap(psmfile):
+    with open(psmfile, 'rb') as fp:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def psm_chunk_offsets(psm_mm, start, chunksize):
+    '''Yield (start, end) byte offsets of chunks of about chunksize bytes
+    of the PSM table, ending on a line end (excluding the newline)'''
+    size = len(psm_mm)
+    while start < size:
+        end = psm_mm.find(b'\n', start + chunksize)
+        if end == -1:
+            end = size - 1 if psm_mm[size-1:] == b'\n' else size
+        yield start, end
+        start = end + 1
+
+
+def init_psm_chunk_state(psm_mm, usecols, msgf_mod_map, labile_masses, labileptms, othermods):
+    _PSM_CHUNK_STATE.update({
+        # Chunks are read from the mapped file, so only offsets are passed around
+        'psm_mm': psm_mm,
+        'get_usecols': itemgetter(*usecols),
+        # Do not split the (many) columns after the last one we need
+        'maxsplit': max(usecols) + 1,
+        'msgf_mod_map': msgf_mod_map,
+        'labile_masses': labile_masses,
+        'labileptms': labileptms,
+        'othermods': othermods,
+        # Peptides recur in many PSMs, so only decode each one once
+        # {msgfpeptide: (sequence, modsites) or False if no labile PTMs}
+        'decoded_peps': {},
+        })
+
+
+def init_psm_chunk_worker(psmfile, *chunk_state):
+    '''Worker processes map the PSM file themselves, maps cannot be pickled'''
+    init_psm_chunk_state(open_psm_mmap(psmfile), *chunk_state)
+
+
+def process_psm_chunk(start, end):
+    '''Parse PSM table lines between byte offsets, return luciphor input rows
+    for the PSMs with labile PTMs'''
+    state = _PSM_CHUNK_STATE
+    lines = state['psm_mm'][start:end].decode().split('\n')
+    get_usecols, maxsplit = state['get_usecols'], state['maxsplit']
+    labile_masses, decoded_peps = state['labile_masses'], state['decoded_peps']
+    outrows = []
+    for line in lines:
+        spfile, scan, charge, evalue, msgfpep = get_usecols(line.split('\t', maxsplit))
+        if msgfpep not in decoded_peps:
+            if not any(mass in msgfpep for mass in labile_masses):
+                decoded_peps[msgfpep] = False
+                continue
+            psm = PSM()
+            psm.parse_msgf_peptide(msgfpep, state['msgf_mod_map'], state['labileptms'], state['othermods'])
+            # TODO add C-terminal mods (rare)
+            if psm.has_labileptms():
+                decoded_peps[msgfpep] = (psm.sequence, psm.luciphor_input_sites())
+            else:
+                decoded_peps[msgfpep] = False
+        decoded = decoded_peps[msgfpep]
+        if decoded:
+            outrows.append(f'\n{spfile}\t{scan}\t{charge}\t{evalue}\t{decoded[0]}\t{decoded[1]}')
+    return ''.join(outrows)
+
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
@@ -310,10 +409,12 @@ def main():
     parser.add_argument('--modfile')
     parser.add_argument('--labileptms', nargs='+', default=[])
     parser.add_argument('--mods', nargs='+', default=[])
+    parser.add_argument('--threads', type=int, default=1)
     args = parser.parse_args(sys.argv[1:])
 
-    labileptms = [x.lower() for x in args.labileptms]
-    othermods = [x.lower() for x in args.mods]
+    # Sets, since mod names are checked for every mod of every PSM
+    labileptms = frozenset(x.lower() for x in args.labileptms)
+    othermods = frozenset(x.lower() for x in args.mods)
     ms2tol = environ.get('MS2TOLVALUE')
     ms2toltype = {'ppm': 1, 'Da': 0}[environ.get('MS2TOLTYPE')]
 
@@ -346,7 +447,7 @@ def main():
             decoy_nloss.append('X -H3PO4 -97.07690')
             
     with open(args.template) as fp, open('luciphor_config.txt', 'w') as wfp:
-        lucitemplate = Template(fp.read())
+        lucitemplate = Environment(undefined=StrictUndefined).from_string(fp.read())
         wfp.write(lucitemplate.render(
             outfile=args.outfile,
             fixedmods=lucifixed,
@@ -363,22 +464,36 @@ def main():
     # translation table needed...
     # But how to spec in luciphor, it also wants fixed/var/target mods? Does it apply fixed regardless?
 
-    msgf_mod_map = msgfmods.msgfmass_mod_dict()
-    with open(args.psmfile) as fp, open(args.lucipsms, 'w') as wfp:
-        header = next(fp).strip('\n').split('\t')
-        pepcol = header.index('Peptide')
-        spfile = header.index('SpectraFile')
-        charge = header.index('Charge')
-        scan = header.index('ScanNum')
-        evalue = header.index('PSM q-value')
+    msgf_mod_map = msgfmods.msgfmass_int_dict()
+    # Only PSMs with labile PTMs are output, so skip parsing peptides which do not contain
+    # any of their masses. MSGF masses are round(x, 3), str() of those is a prefix of them
+    labile_masses = {str(abs(mod['msgf_mass'])) for mod in msgfmods.varmods
+            if mod['name_lower'] in labileptms}
+    with open_psm_mmap(args.psmfile) as psm_mm, open(args.lucipsms, 'w', buffering=1<<20) as wfp:
+        header_end = psm_mm.find(b'\n')
+        if header_end == -1:
+            header_end = len(psm_mm)
+        header = psm_mm[:header_end].decode().split('\t')
+        usecols = [header.index(x) for x in ['SpectraFile', 'ScanNum', 'Charge', 'PSM q-value', 'Peptide']]
+        chunk_state = (usecols, msgf_mod_map, labile_masses, labileptms, othermods)
         wfp.write('srcFile\tscanNum\tcharge\tPSMscore\tpeptide\tmodSites')
-        for line in fp:
-            line = line.strip('\n').split('\t')
-            psm = PSM()
-            psm.parse_msgf_peptide(line[pepcol], msgf_mod_map, labileptms, othermods)
-            # TODO add C-terminal mods (rare)
-            if psm.has_labileptms():
-                wfp.write('\n{}\t{}\t{}\t{}\t{}\t{}'.format(line[spfile], line[scan], line[charge], line[evalue], psm.sequence, psm.luciphor_input_sites()))
+        # PSMs are independent, process the table in chunks of ~16MB of lines
+        chunks = psm_chunk_offsets(psm_mm, header_end + 1, 1<<24)
+        if args.threads > 1:
+            with ProcessPoolExecutor(max_workers=args.threads, initializer=init_psm_chunk_worker,
+                    initargs=(args.psmfile, *chunk_state)) as executor:
+                # Keep a limited amount of chunks in flight and write them in input order
+                running = deque()
+                for chunk in chunks:
+                    running.append(executor.submit(process_psm_chunk, *chunk))
+                    if len(running) > 2 * args.threads:
+                        wfp.write(running.popleft().result())
+                for job in running:
+                    wfp.write(job.result())
+        else:
+            init_psm_chunk_state(psm_mm, *chunk_state)
+            for chunk in chunks:
+                wfp.write(process_psm_chunk(*chunk))
 
 
 if __name__ == '__main__':
@@ -20,13 +20,12 @@ def main():
     parser.add_argument('--fasta')
     args = parser.parse_args(sys.argv[1:])
 
-    ptms = [x.lower() for x in args.stabileptms]
-    locptms = [x.lower() for x in args.labileptms]
-    mods = [x.lower() for x in args.mods]
+    ptms = frozenset(x.lower() for x in args.stabileptms)
+    locptms = frozenset(x.lower() for x in args.labileptms)
 
     msgfmods = Mods()
-    msgfmods.parse_msgf_modfile(args.modfile, [*locptms, *ptms, *mods])
-    msgf_mod_map = msgfmods.msgfmass_mod_dict()
+    msgfmods.parse_msgf_modfile(args.modfile, [*args.labileptms, *args.stabileptms, *args.mods])
+    msgf_mod_map = msgfmods.msgfmass_int_dict()
     tdb = SeqIO.index(args.fasta, 'fasta')
     with open(args.psms) as fp, open(args.outfile, 'w') as wfp:
         header = next(fp).strip('\n').split('\t')
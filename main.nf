@@ -1094,7 +1094,7 @@ process luciphorPTMLocalizationScoring {
   cat "$baseDir/assets/luciphor2_input_template.txt" | envsubst > lucinput.txt
   luciphor_prep.py --psmfile target.tsv --template lucinput.txt --modfile "${params.msgfmods}" \
       --labileptms "${params.locptms}" --mods ${mods} ${isobtype} ${stab_ptms} \
-      -o luciphor.out --lucipsms lucipsms
+      -o luciphor.out --lucipsms lucipsms --threads ${task.cpus}
   luciphor2 -Xmx${task.memory.toGiga()}G luciphor_config.txt 2>&1 | grep 'not have enough PSMs' && echo 'Not enough PSMs for luciphor FLR calculation in set ${setname}' > warnings
   luciphor_parse.py --minscore ${params.ptm_minscore_high} -o labileptms.txt \
      --luci_in luciphor.out --luci_scores all_scores.debug --psms psms \